@@ -1,10 +1,39 @@
+import asyncio
 import ctypes
+import functools
+import mmap
 import numpy as np
 from picosdk.ps2000a import ps2000a as ps
-from picosdk.functions import adc2mV, assert_pico_ok
+from picosdk.functions import assert_pico_ok
+from sensor_classes import escape_key
 import time
 import datetime
 
+CHANNELS = {letter: ps.PS2000A_CHANNEL["PS2000A_CHANNEL_" + letter] for letter in "ABCD"}
+CHANNEL_RANGES_MV = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000]
+SAMPLE_UNITS_S = {"PS2000A_FS": 1e-15, "PS2000A_PS": 1e-12, "PS2000A_NS": 1e-9, "PS2000A_US": 1e-6, "PS2000A_MS": 1e-3, "PS2000A_S": 1}
+
+
+@functools.lru_cache(maxsize=None)
+def line_template(name, aliases, tags, counts=False):
+    """
+    Build the line protocol format string for a Picoscope data point. Templates are cached, so repeated captures
+    with the same channels and tags reuse the same string.
+
+    Args:
+        name (string): Measurement name
+        aliases (tuple): Channel aliases
+        tags (tuple): Sorted (key, value) tag pairs
+        counts (bool): Write the values as integer ADC counts instead of floats
+
+    Returns:
+        Format string taking the channel values followed by the timestamp in nanoseconds
+    """
+    tag_str = "".join(",%s=%s" % (escape_key(key), escape_key(value)) for key, value in tags)
+    value_format = "%di" if counts else "%r"
+    field_str = ",".join("%s=%s" % (escape_key(alias), value_format) for alias in aliases)
+    return "%s%s %s %%d" % (escape_key(name), tag_str, field_str)
+
 
 class Channel():
     """
@@ -29,14 +58,14 @@ class Channel():
         coupling (string): Channel coupling
         range (string): Channel range
         offset (float): Channel offset
-        buffer (list): Channel buffer
-        buffer_complete (list): Complete channel buffer
+        buffer (np.ndarray): Channel buffer, a row view of the Picoscope driver buffers
+        buffer_complete (np.ndarray): Complete channel buffer, a row view of the Picoscope complete buffers
     """
     def __init__(self, chandle, alias, letter="A", enabled=True, coupling="PS2000A_DC", range="PS2000A_2V", offset=0):
         self.chandle = chandle
         self.alias = alias
         self.letter = letter
-        self.channel = ps.PS2000A_CHANNEL["PS2000A_CHANNEL_" + letter]
+        self.channel = CHANNELS[letter]
         self.enabled = int(enabled)
         self.coupling = ps.PS2000A_COUPLING[coupling]
         self.range = ps.PS2000A_RANGE[range]
@@ -53,27 +82,27 @@ class Channel():
         """
         return ps.ps2000aSetChannel(self.chandle, self.channel, self.enabled, self.coupling, self.range, self.offset)
 
-    def create_buffer(self, size, num, ratio_mode):
+    def create_buffer(self, buffer, buffer_complete, ratio_mode):
         """
         Create channel buffer.
 
         Args:
-            size (int): Size of a single buffer
-            num (int): Number of buffers to capture
-            ratio_mode (string): Buffer ratio mode
+            buffer (np.ndarray): Contiguous int16 array for a single buffer
+            buffer_complete (np.ndarray): Contiguous int16 array for all captured buffers
+            ratio_mode (int): Buffer ratio mode enum value
 
         Returns:
             Buffer setup status
         """
-        self.buffer = np.zeros(shape=size, dtype=np.int16)
-        self.buffer_complete = np.zeros(shape=size * num, dtype=np.int16)
+        self.buffer = buffer
+        self.buffer_complete = buffer_complete
         return ps.ps2000aSetDataBuffers(self.chandle,
                                         self.channel,
                                         self.buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
                                         None,
-                                        size,
+                                        self.buffer.size,
                                         0,
-                                        ps.PS2000A_RATIO_MODE[ratio_mode])
+                                        ratio_mode)
 
 
 class Streamer():
@@ -81,16 +110,25 @@ class Streamer():
     Picoscope streamer object.
 
     Args:
-        channels (dict): Dictionary of channel aliases and channel objects
+        buffers (np.ndarray): Driver buffers of all channels with shape (channels, size)
+        buffers_complete (np.ndarray): Complete buffers of all channels with shape (channels, size * num)
 
     Attrs:
-        channels (dict): Dictionary of channel aliases and channel objects
+        buffers (np.ndarray): Driver buffers of all channels with shape (channels, size)
+        buffers_complete (np.ndarray): Complete buffers of all channels with shape (channels, size * num)
         next (int): Number of next sample
         auto_stop (bool): Auto stop streaming
         called_back (bool): Picoscope streamer was already called back
     """
-    def __init__(self, channels):
-        self.channels = channels
+    def __init__(self, buffers, buffers_complete):
+        self.buffers = buffers
+        self.buffers_complete = buffers_complete
+        self.next = 0
+        self.auto_stop = False
+        self.called_back = False
+
+    def reset(self):
+        """Reset the streamer for a new capture."""
         self.next = 0
         self.auto_stop = False
         self.called_back = False
@@ -98,11 +136,10 @@ class Streamer():
     def callback(self, handle, num_samples, start_idx, overflow, trigger_at, triggered, auto_stop, param):
         """Streamer callback function."""
         self.called_back = True
-        dest_end = self.next + num_samples
-        source_end = start_idx + num_samples
-        for channel in self.channels.values():
-            channel.buffer_complete[self.next:dest_end] = channel.buffer[start_idx:source_end]
-        self.next += num_samples
+        dest_start = self.next
+        dest_end = dest_start + num_samples
+        self.buffers_complete[:, dest_start:dest_end] = self.buffers[:, start_idx:start_idx + num_samples]
+        self.next = dest_end
         if auto_stop:
             self.auto_stop = True
 
@@ -120,7 +157,14 @@ class Picoscope():
         status (dict): Dictionary of picoscope status objects
         channels (dict): Dictionary of channel aliases and channel objects
         buffer_settings (dict): Dictionary of buffer settings
-        sample_interval (float): Sample interval
+        buffers (np.ndarray): Driver buffers of all channels with shape (channels, size)
+        buffers_complete (np.ndarray): Complete buffers of all channels with shape (channels, size * num)
+        buffer_storage: Bytearray or shared memory backing the complete buffers, for zero-copy views from other libraries
+        streamer (Streamer): Streamer for the current buffers
+        streamer_callback: C function pointer wrapping the streamer callback
+        sample_interval (int): Sample interval reported by the driver
+        sample_units (string): Sample units
+        tags (dict): Tags attached to every data point
     """
     def __init__(self, name):
         self.chandle = ctypes.c_int16()
@@ -129,9 +173,16 @@ class Picoscope():
         assert_pico_ok(self.status["openunit"])
         self.channels = {}
         self.buffer_settings = {}
+        self.buffers = None
+        self.buffers_complete = None
+        self.buffer_storage = None
+        self.streamer = None
+        self.streamer_callback = None
         self.sample_interval = 0
+        self.sample_units = "PS2000A_US"
         self.stream_start = datetime.datetime.utcnow()
         self.raw_data = {}
+        self.tags = {}
         self.data = []
         self.name = name
 
@@ -149,21 +200,40 @@ class Picoscope():
         self.status[channel_setup_name] = channel.setup()
         assert_pico_ok(self.status[channel_setup_name])
 
-    def setup_buffer(self, size=500, num=10, ratio_mode="PS2000A_RATIO_MODE_NONE"):
+    def setup_buffer(self, size=500, num=10, ratio_mode="PS2000A_RATIO_MODE_NONE", shared=False):
         """
         Setup buffer for all channels.
 
+        If the channels, size and num match the previous call, the existing buffers are registered again instead of
+        being reallocated, and the next capture overwrites them in place. Arrays from an earlier generate_body call
+        with counts=True are views of these buffers, so copy them first if they are still needed. Shared buffers are
+        always reallocated, since child processes may still be reading views of the previous ones.
+
         For ratio mode options, see https://www.picotech.com/download/manuals/picoscope-2000-series-programmers-guide.pdf
 
         Args:
             size (int): Size of a single buffer
             num (int): Number of buffers to capture
             ratio_mode (string): Buffer ratio mode
+            shared (bool): Back the complete buffers with anonymous shared memory instead of a bytearray, so that
+                child processes can read the captured data without copying it
         """
-        self.buffer_settings = dict(size=size, num=num, ratio_mode=ratio_mode)
-        for channel in self.channels.values():
+        self.buffer_settings = dict(size=size, num=num, ratio_mode=ratio_mode, ratio_mode_id=ps.PS2000A_RATIO_MODE[ratio_mode])
+        reuse = (self.buffers is not None
+                 and self.buffers.shape == (len(self.channels), size)
+                 and self.buffers_complete.shape == (len(self.channels), size * num)
+                 and not shared
+                 and not isinstance(self.buffer_storage, mmap.mmap))
+        if not reuse:
+            self.buffers = np.zeros(shape=(len(self.channels), size), dtype=np.int16)
+            nbytes = len(self.channels) * size * num * np.dtype(np.int16).itemsize
+            self.buffer_storage = mmap.mmap(-1, nbytes) if shared else bytearray(nbytes)
+            self.buffers_complete = np.frombuffer(self.buffer_storage, dtype=np.int16).reshape(len(self.channels), size * num)
+            self.streamer = Streamer(self.buffers, self.buffers_complete)
+            self.streamer_callback = ps.StreamingReadyType(self.streamer.callback)
+        for channel, buffer, buffer_complete in zip(self.channels.values(), self.buffers, self.buffers_complete):
             channel_buffer_name = "setDataBuffers" + channel.letter
-            self.status[channel_buffer_name] = channel.create_buffer(**self.buffer_settings)
+            self.status[channel_buffer_name] = channel.create_buffer(buffer, buffer_complete, self.buffer_settings["ratio_mode_id"])
             assert_pico_ok(self.status[channel_buffer_name])
 
     def setup_stream(self, sample_interval=250, sample_units="PS2000A_US", downsample_ratio=1):
@@ -177,49 +247,114 @@ class Picoscope():
             sample_units (string): Sample units
             downsample_ratio (int): Downsample ratio
         """
-        self.sample_interval = ctypes.c_int32(sample_interval)
+        c_sample_interval = ctypes.c_int32(sample_interval)
+        self.sample_units = sample_units
         self.status["runStreaming"] = ps.ps2000aRunStreaming(self.chandle,
-                                                             ctypes.byref(self.sample_interval),
+                                                             ctypes.byref(c_sample_interval),
                                                              ps.PS2000A_TIME_UNITS[sample_units],
                                                              0,
                                                              self.buffer_settings["size"] * self.buffer_settings["num"],
                                                              1,
                                                              downsample_ratio,
-                                                             ps.PS2000A_RATIO_MODE[self.buffer_settings["ratio_mode"]],
+                                                             self.buffer_settings["ratio_mode_id"],
                                                              self.buffer_settings["size"])
         assert_pico_ok(self.status["runStreaming"])
+        self.sample_interval = c_sample_interval.value
+
+    def stream(self, spin_delay=0.001, min_delay=0.0001):
+        """
+        Stream data.
+
+        The polling delay adapts to the driver: it is halved after every callback and doubled after every poll
+        without one, up to the time needed to fill a single buffer.
 
-    def stream(self):
-        """Stream data."""
-        streamer = Streamer(self.channels)
-        cfunc_pointer = ps.StreamingReadyType(streamer.callback)
+        Args:
+            spin_delay (float): Initial polling delay in seconds
+            min_delay (float): Minimum polling delay in seconds
+        """
+        streamer = self.streamer
+        cfunc_pointer = self.streamer_callback
+        streamer.reset()
+        buffer_time = self.buffer_settings["size"] * self.sample_interval * SAMPLE_UNITS_S[self.sample_units]
+        max_delay = max(min_delay, buffer_time)
+        delay = spin_delay
         self.stream_start = datetime.datetime.utcnow()
         while streamer.next < self.buffer_settings["size"] * self.buffer_settings["num"] and not streamer.auto_stop:
             streamer.called_back = False
             self.status["getStreamingLastestValues"] = ps.ps2000aGetStreamingLatestValues(self.chandle, cfunc_pointer, None)
-            if not streamer.called_back:
-                time.sleep(0.01)
+            if streamer.called_back:
+                delay = max(min_delay, delay / 2)
+            else:
+                time.sleep(delay)
+                delay = min(max_delay, delay * 2)
+        # Samples past an auto stop would otherwise keep the values of a previous capture
+        self.buffers_complete[:, streamer.next:] = 0
+
+    async def stream_async(self, **kwargs):
+        """
+        Stream data in the default executor so other sensors can be read while the Picoscope is streaming.
+
+        Args:
+            **kwargs: Picoscope.stream arguments
+        """
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(self.stream, **kwargs))
 
     def process_data(self):
         """Process data"""
-        total_samples = self.buffer_settings["size"] * self.buffer_settings["num"]
-        for i in range(total_samples):
-            measurement_time = str(self.stream_start + datetime.timedelta(microseconds=self.raw_data["time"][i]))
-            data_body = dict(measurement=self.name, time=measurement_time, fields={})
-            for channel_name in self.channels.keys():
-                data_body["fields"][channel_name] = self.raw_data[channel_name][i]
-            self.data.append(data_body)
-
-    def generate_body(self):
-        """Retrieve data."""
+        measurement_times = self.raw_data["time_ns"].tolist()
+        aliases = list(self.channels.keys())
+        values = np.column_stack([self.raw_data[alias] for alias in aliases]).tolist()
+        self.data.extend(dict(measurement=self.name, tags=self.tags, time=measurement_time, fields=dict(zip(aliases, row)))
+                         for measurement_time, row in zip(measurement_times, values))
+
+    def encode_lines(self, counts=False):
+        """
+        Encode data as InfluxDB line protocol.
+
+        Args:
+            counts (bool): Write the values as integer ADC counts instead of floats
+
+        Returns:
+            List of line protocol strings, one per sample
+        """
+        aliases = tuple(self.channels.keys())
+        template = line_template(self.name, aliases, tuple(sorted(self.tags.items())), counts)
+        times_ns = self.raw_data["time_ns"].tolist()
+        values = np.column_stack([self.raw_data[alias] for alias in aliases]).tolist()
+        return [template % (*row, time_ns) for row, time_ns in zip(values, times_ns)]
+
+    def generate_body(self, protocol="json", counts=False):
+        """
+        Retrieve data.
+
+        With counts=True the raw int16 ADC counts are stored without conversion and the mV per count of each channel
+        is attached as a tag, so the data can be converted to mV when it is displayed. Counts are written as integer
+        fields, so use a different picoscope name than for data converted to mV.
+
+        Args:
+            protocol (string): Data format. Either "json" for point dictionaries or "line" for line protocol strings
+            counts (bool): Store raw ADC counts instead of mV
+        """
         max_ADC = ctypes.c_int16()
         self.status["maximumValue"] = ps.ps2000aMaximumValue(self.chandle, ctypes.byref(max_ADC))
         assert_pico_ok(self.status["maximumValue"])
         total_samples = self.buffer_settings["size"] * self.buffer_settings["num"]
-        self.raw_data["time"] = np.linspace(0, total_samples * self.sample_interval.value, total_samples)
-        for alias, channel in self.channels.items():
-            self.raw_data[alias] = adc2mV(channel.buffer_complete, channel.range, max_ADC)
-        self.process_data()
+        self.raw_data["time"] = np.arange(total_samples, dtype=np.int64) * self.sample_interval
+        sample_unit_ns = SAMPLE_UNITS_S[self.sample_units] * 1e9
+        self.raw_data["time_ns"] = np.datetime64(self.stream_start, "ns").astype(np.int64) + np.rint(self.raw_data["time"] * sample_unit_ns).astype(np.int64)
+        scales = np.array([CHANNEL_RANGES_MV[channel.range] / max_ADC.value for channel in self.channels.values()], dtype=np.float32)
+        if counts:
+            self.tags = {"%s mV_per_count" % alias: repr(float(scale)) for alias, scale in zip(self.channels.keys(), scales)}
+            channel_data = self.buffers_complete
+        else:
+            self.tags = {}
+            channel_data = self.buffers_complete * scales[:, np.newaxis]
+        for alias, channel_values in zip(self.channels.keys(), channel_data):
+            self.raw_data[alias] = channel_values
+        if protocol == "line":
+            self.data.extend(self.encode_lines(counts))
+        else:
+            self.process_data()
 
     def stop(self):
         """Stop picoscope."""
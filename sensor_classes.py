@@ -1,44 +1,179 @@
-from influxdb import InfluxDBClient
-import datetime
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import io
+import itertools
 import json
+import math
+import numbers
 import os
+import queue
+import random
+import re
 import time
+import warnings
 import numpy as np
 import sys
 import subprocess
+import threading
 import logging
+import logging.handlers
 from configparser import ConfigParser
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+try:
+    import adafruit_dht
+    import board
+    import psutil
+except (ImportError, NotImplementedError):
+    adafruit_dht = board = psutil = None
+
+try:
+    from mcculw import ul
+    from mcculw.enums import TempScale, InfoType, BoardInfo, TcType
+    from mcculw.ul import ULError
+    from ai import AnalogInputProps
+    import util
+except ImportError:
+    ul = None
+
+
+log = logging.getLogger("sensors")
+if not log.handlers:
+    # Buffer messages and write them in batches, flushing straight away for warnings and errors
+    log.addHandler(logging.handlers.MemoryHandler(100, flushLevel=logging.WARNING, target=logging.StreamHandler(sys.stdout)))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+
+def flush_log():
+    """Write out buffered log messages."""
+    for handler in log.handlers:
+        handler.flush()
+
+
+def __getattr__(name):
+    """Import InfluxDBClient on first use, so scripts that only read sensors do not pay for importing influxdb."""
+    if name == "InfluxDBClient":
+        from influxdb import InfluxDBClient
+        globals()["InfluxDBClient"] = InfluxDBClient
+        return InfluxDBClient
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
+config_cache = {}
+
+BACKUP_FILE_RE = re.compile(r"-missed(-line)?(?:-(n|u|ms|s|m|h))?\.(?:ndjson|txt)(\.zst)?(\.uploading)?$")
+
+TIME_PRECISION_NS = {"n": 1, "u": 10**3, "ms": 10**6, "s": 10**9, "m": 60 * 10**9, "h": 3600 * 10**9}
+
 
 def parse_config(config_path):
-    config = ConfigParser()
-    config.read(config_path)
-    influxdb = config["influxdb"]
-    influxdb_params = {
-        "url": influxdb["url"],
-        "port": influxdb["port"],
-        "username": influxdb["username"],
-        "pwd": influxdb["password"],
-        "db_name": influxdb["database"]
-    }
-    return influxdb_params
+    """
+    Parse an InfluxDB config file. Parsed files are cached until their modification time changes.
 
+    Args:
+        config_path (str): Path of the config file.
 
-def install(module):
-    subprocess.check_call([sys.executable, "-m", "pip", "install", module])
+    Returns:
+        Dictionary of Logger.connect arguments.
+    """
+    key = (config_path, os.stat(config_path).st_mtime_ns)
+    if key not in config_cache:
+        config = ConfigParser()
+        config.read(config_path)
+        influxdb = config["influxdb"]
+        config_cache[key] = {
+            "url": influxdb["url"],
+            "port": influxdb["port"],
+            "username": influxdb["username"],
+            "pwd": influxdb["password"],
+            "db_name": influxdb["database"]
+        }
+    return dict(config_cache[key])
+
+
+def dump_ndjson(data):
+    """
+    Serialize data points as newline-delimited JSON, one point per line.
+    Uses orjson when it is installed and the standard library otherwise.
+
+    Args:
+        data (list): JSON-serializable data points. NumPy arrays and scalars are supported with orjson.
+
+    Returns:
+        Encoded bytes.
+    """
+    if orjson is not None:
+        return b"".join(orjson.dumps(point, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n" for point in data)
+    return "".join(json.dumps(point) + "\n" for point in data).encode()
+
+
+def open_backup(path, compressed=None):
+    """
+    Open a backup file for reading text line by line. Compressed files are decompressed with zstandard.
+
+    Args:
+        path (str): Path of the file.
+        compressed (bool): Whether the file is compressed. Defaults to whether the path ends in ".zst".
+
+    Returns:
+        Text file object.
+    """
+    if compressed is None:
+        compressed = path.endswith(".zst")
+    if compressed:
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(io.BufferedReader(reader))
+    return open(path, "r")
+
+
+def escape_key(key):
+    """Escape a measurement name or field key for InfluxDB line protocol."""
+    return key.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def is_valid_field(value):
+    """Check whether a value can be written as a line protocol field. None, NaN and infinite values cannot."""
+    return value is not None and not (isinstance(value, numbers.Real) and not math.isfinite(value))
 
 
-class GlobalImport:
-    """Context manager for global imports."""
-    def __enter__(self):
-        return self
+def calc_dewpt(temp, humid):
+    """
+    Calculate dew point. Works element-wise on arrays of readings as well as on single readings.
 
-    def __call__(self):
-        import inspect
-        self.collector = inspect.getargvalues(inspect.getouterframes(inspect.currentframe())[1].frame).locals
+    Args:
+        temp (float or np.ndarray): Temperature.
+        humid (float or np.ndarray): Humidity.
 
-    def __exit__(self, *args):
-        globals().update(self.collector)
+    Returns:
+        Dew point.
+    """
+    # math.log avoids the NumPy call overhead for single readings, but raises instead of returning -inf or nan for
+    # humidities that are not positive
+    ln = math.log if np.ndim(humid) == 0 and humid > 0 else np.log
+    gamma = ln(humid / 100.0) + 17.67 * temp / (243.5 + temp)
+    dp = 243.5 * gamma / (17.67 - gamma)
+    return dp
+
+
+def install(module):
+    subprocess.check_call([sys.executable, "-m", "pip", "install", module])
 
 
 class Sensor(object):
@@ -58,27 +193,82 @@ class Sensor(object):
         units (list): A list of measurement units for each channel.
         values (list): A list of values for each measurement.
         print_m (bool): Print the measurements.
+        line_templates (dict): Line protocol format strings for each measurement name.
+        field_keys (list): InfluxDB field key for each channel.
+        escaped_field_keys (list): Field keys escaped for line protocol.
     """
+    filter = None
+
     def __init__(self, name, timeout=100, print_m=False):
         self.name = name
         self.timeout = timeout
         self.channels = []
-        self.filter = None
         self.units = []
         self.values = []
         self.print_m = print_m
+        self.line_templates = {}
+        self.field_keys = []
+        self.escaped_field_keys = []
+
+    async def read_async(self):
+        """Read the sensor in the default executor so other sensors can be read concurrently."""
+        await asyncio.get_running_loop().run_in_executor(None, self.read)
+
+    def cache_field_keys(self):
+        """Build the field keys for the current channels. Called by Logger.add_sensors once the channels are defined."""
+        self.field_keys = ["{} {}".format(self.name, channel) for channel in self.channels]
+        self.escaped_field_keys = [escape_key(key) for key in self.field_keys]
+        self.line_templates = {}
+
+    def line_template(self, measurement):
+        """
+        Get the line protocol format string for all channels of the sensor. The template is built on first use and
+        cached for each measurement name.
+
+        Args:
+            measurement (str): Measurement name.
+
+        Returns:
+            Format string taking the channel values followed by the timestamp.
+        """
+        if measurement not in self.line_templates:
+            fields = ",".join("%s=%%s" % key.replace("%", "%%") for key in self.escaped_field_keys)
+            self.line_templates[measurement] = "%s %s %%d" % (escape_key(measurement).replace("%", "%%"), fields)
+        return self.line_templates[measurement]
+
+    def format_line(self, measurement, timestamp, mask=None):
+        """
+        Format the current values as an InfluxDB line protocol string.
+
+        Args:
+            measurement (str): Measurement name.
+            timestamp (int): Timestamp.
+            mask (list): Filter mask. Values with a False mask entry are left out. None, NaN and infinite values are
+                always left out.
+
+        Returns:
+            Line protocol string, or None if no values pass the filter.
+        """
+        valid = list(map(is_valid_field, self.values))
+        if (mask is None or all(mask)) and all(valid) and len(self.values) == len(self.escaped_field_keys):
+            return self.line_template(measurement) % (*self.values, timestamp)
+        if mask is None:
+            mask = valid
+        fields = ",".join("%s=%s" % (key, value)
+                          for filter_pass, is_valid, key, value in zip(mask, valid, self.escaped_field_keys, self.values)
+                          if filter_pass and is_valid)
+        return "%s %s %d" % (escape_key(measurement), fields, timestamp) if fields else None
 
     def print_measurements(self):
-        """Print measurements in a human-readable string."""
-        if self.print_m:
-            measurements_str = ["'%s': %.3g %s" % (channel, value, unit) for channel, value, unit in zip(self.channels, self.values, self.units)]
-            print("On sensor '%s' read: %s." % (self.name, ", ".join(measurements_str)))
+        """Log measurements in a human-readable string."""
+        if self.print_m and log.isEnabledFor(logging.INFO):
+            measurements_str = ", ".join("'%s': %.3g %s" % item for item in zip(self.channels, self.values, self.units))
+            log.info("On sensor '%s' read: %s.", self.name, measurements_str)
 
     def print_error(self, e):
-        """Print error."""
+        """Log error."""
         if self.print_m:
-            error_class = e.__class__.__name__
-            print("On sensor '%s' error: %s: '%s.'" % (self.name, error_class, e))
+            log.error("On sensor '%s' error: %s: '%s.'", self.name, e.__class__.__name__, e)
 
 class Arduino_Sensor(Sensor):
     """
@@ -91,24 +281,70 @@ class Arduino_Sensor(Sensor):
     Attrs:
         board_port (int): Arduino board port.
         baud (int): Baud rate. Defaults to 9600.
+        ser: Serial connection, opened once and reused for every read.
+        buffer (bytearray): Received bytes after the last complete line.
+        synced (bool): Whether the first, possibly partial, line after opening the port has been discarded.
+        max_buffer_size (int): Received bytes are discarded if this many arrive without a newline.
     """
+    max_buffer_size = 4096
+
     def __init__(self, name, board_port, baud=9600, **kwargs):
-        with GlobalImport() as gi:
-            import serial
-            gi()
+        if serial is None:
+            raise ImportError("Arduino sensors require the pyserial library.")
         super().__init__(name, **kwargs)
         self.board_port = board_port
         self.baud = baud
+        self.ser = serial.Serial()
+        self.ser.port = self.board_port
+        self.ser.baudrate = self.baud
+        self.ser.timeout = self.timeout / 1000
+        self.ser.dtr = False  # Keep DTR low while opening so the Arduino is not reset
+        self.ser.open()
+        self.ser.reset_input_buffer()  # Drop anything queued before the port was opened
+        try:
+            self.ser.set_low_latency_mode(True)  # Lower the USB adapter latency timer on Linux
+        except (AttributeError, NotImplementedError, ValueError):
+            pass
+        atexit.register(self.ser.close)
+        self.buffer = bytearray()
+        self.synced = False
 
     def read(self):
-        """Expects serial input to be measurement values separated by commas."""
+        """
+        Expects serial input to be measurement values separated by commas, one line per reading.
+        Reads the bytes that have arrived, waiting at most the sensor timeout, and parses the most recent complete line.
+        If no complete line has arrived yet, or the line does not have one value per channel, values is left empty so
+        nothing is logged for the sensor. Everything up to the first newline after opening the port is discarded,
+        because the port may have been opened in the middle of a line.
+        """
         try:
-            ser = serial.Serial(self.board_port, self.baud)
-            self.values = [float(value) for value in ser.readline().decode('utf-8').split(",")[:-1]]
+            self.values = []
+            self.buffer += self.ser.read(max(1, self.ser.in_waiting))
+            if not self.synced:
+                first = self.buffer.find(b"\n")
+                if first >= 0:
+                    del self.buffer[:first + 1]
+                    self.synced = True
+            end = self.buffer.rfind(b"\n") if self.synced else -1
+            if end < 0:
+                if len(self.buffer) > self.max_buffer_size:
+                    log.warning("No newline from sensor '%s' in %d bytes. Discarding them.", self.name, len(self.buffer))
+                    self.buffer.clear()
+                return
+            start = self.buffer.rfind(b"\n", 0, end) + 1
+            values = np.fromstring(bytes(self.buffer[start:end]).rstrip(b"\r,"), sep=",").tolist()
+            del self.buffer[:end + 1]
+            if len(values) != len(self.channels):
+                log.warning("Sensor '%s' sent %d values for %d channels. Discarding the reading.",
+                            self.name, len(values), len(self.channels))
+                return
+            self.values = values
         except Exception as err:
-            print("Error reading data from sensor '%s'" % self.name)
-            print(err)
+            log.error("Error reading data from sensor '%s': %s", self.name, err)
 
+    def close(self):
+        """Close the serial connection."""
+        self.ser.close()
 
 
 class Pi_Sensor(Sensor):
@@ -129,9 +365,6 @@ class Pi_Sensor(Sensor):
 class Test_Sensor(Sensor):
     """Class for testing and debugging sensor code. Inherits from Sensor class."""
     def __init__(self, name, **kwargs):
-        with GlobalImport() as gi:
-            import random
-            gi()
         super().__init__(name, **kwargs)
         self.channels = ["test1", "test2"]
         self.units = ["units", "units"]
@@ -143,17 +376,15 @@ class Test_Sensor(Sensor):
 class Temp_Humid_Sensor(Pi_Sensor):
     """DHT22 temperature-huditity sensor class. Inherits from Pi_Sensor."""
     def __init__(self, name, pin, first=False, **kwargs):
-        with GlobalImport() as gi:
-            import adafruit_dht
-            import board
-            import psutil
-            gi()
+        if adafruit_dht is None:
+            raise ImportError("The DHT22 sensor requires the adafruit_dht, board, and psutil libraries.")
         super().__init__(name, pin=pin, **kwargs)
         self.channels = ["temperature", "humidity", "dew_point"]
         self.units = ["C", "%", "%"]
         if first:
             self.kill_processes()
         self.device = adafruit_dht.DHT22(getattr(board, "D" + str(self.pin)))
+        self.lock = threading.Lock()  # adafruit_dht is not thread-safe, so reads from different threads must not overlap
 
     def kill_processes(self):
         """Kills processes left open by adafruit_dht library."""
@@ -161,25 +392,13 @@ class Temp_Humid_Sensor(Pi_Sensor):
             if p.name() in ["libgpiod_pulsein", "libgpiod_pulsei"]:
                 p.kill()
 
-    def calc_dewpt(self, temp, humid):
-        """
-        Calculate dew point.
-
-        Args:
-            temp (float): Temperature.
-            humid (float): Humidity.
-
-        Returns:
-            Dew point.
-        """
-        gamma = np.log(humid / 100.0) + 17.67 * temp / (243.5 + temp)
-        dp = 243.5 * gamma / (17.67 - gamma)
-        return dp
+    calc_dewpt = staticmethod(calc_dewpt)
 
     def read(self):
-        temp = self.device.temperature
-        humid = self.device.humidity
-        dewpoint = self.calc_dewpt(temp, humid)
+        with self.lock:
+            temp = self.device.temperature
+            humid = self.device.humidity
+        dewpoint = calc_dewpt(temp, humid)
         self.values = [temp, humid, dewpoint]
 
 
@@ -221,55 +440,73 @@ class Thermocouple(Sensor):
 
     Args:
         use_device_detection (bool): Use device detection. Defaults to True.
-        delay (float): Time delay per data reading in seconds. Defaults to 1 second.
+        delay (float): Deprecated and ignored. The logging loop sets the sampling interval.
+
+    Attrs:
+        min_temp (float): Readings at or below this temperature are filtered out.
+        max_temp (float): Readings at or above this temperature are filtered out.
+        board_num (int): Board number of the DAQ device.
+        ai_props (AnalogInputProps): Analog input properties of the DAQ device.
+        executor (concurrent.futures.ThreadPoolExecutor): Thread pool for reading the channels concurrently.
     """
-    def __init__(self, name, use_device_detection=True, delay=1, **kwargs):
-        with GlobalImport() as gi:
-            from mcculw import ul
-            from mcculw.enums import TempScale, InfoType, GlobalInfo, BoardInfo, DigitalInfo, ExpansionInfo, TcType, AiChanType
-            from mcculw.ul import ULError
-            from ai import AnalogInputProps
-            import pyvisa
-            gi()
+    min_temp = 0
+    max_temp = 1000
+
+    def __init__(self, name, use_device_detection=True, delay=None, **kwargs):
+        if ul is None:
+            raise ImportError("The thermocouple sensor requires the mcculw library.")
         super().__init__(name, **kwargs)
         self.channels = ["temp"]
         self.units = ["C"]
         self.use_device_detection = use_device_detection
-        self.delay = delay
+        if delay is not None:
+            warnings.warn("Thermocouple delay is deprecated and ignored; the logging loop sets the sampling interval.",
+                          DeprecationWarning, stacklevel=2)
+        self.board_num = 0
+        if self.use_device_detection:
+            ul.ignore_instacal()
+            if not util.config_first_detected_device(self.board_num):
+                raise IOError("Thermocouple error: Could not find device.")
+        self.ai_props = AnalogInputProps(self.board_num)
+        if self.ai_props.num_ti_chans < 1:
+            util.print_unsupported_example(self.board_num)
+            self.close()
+            raise IOError("Thermocouple error: Device has no temperature input channels.")
+        for channel in range(8):
+            ul.set_config(InfoType.BOARDINFO, self.board_num, channel, BoardInfo.CHANTCTYPE, TcType.J)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
 
     def get_temp(self, channel):
         """
-        Get the temperature reading from a thermocouple.
+        Get the temperature reading from a thermocouple. The device is configured once when the sensor is created.
 
         Args:
             channel (int): The channel of the thermocouple.
         """
-        board_num = 0
-        if self.use_device_detection:
-            ul.ignore_instacal()
-            if not util.config_first_detected_device(board_num):
-                print("Thermocouple warning: Could not find device.")
-                return
-        ul.set_config(InfoType.BOARDINFO, board_num, channel, BoardInfo.CHANTCTYPE, TcType.J)
-        ai_props = AnalogInputProps(board_num)
-        if ai_props.num_ti_chans < 1:
-            util.print_unsupported_example(board_num)
-            return
         try:
-            return float(ul.t_in(board_num, channel, TempScale.CELSIUS))
+            return float(ul.t_in(self.board_num, channel, TempScale.CELSIUS))
         except ULError as e:
             util.print_ul_error(e)
             return 0
-        finally:
-            if self.use_device_detection:
-                ul.release_daq_device(board_num)
+
+    def read_channels(self):
+        """Read the temperature of all thermocouple channels concurrently."""
+        self.values = list(self.executor.map(self.get_temp, range(8)))
+        return self.values
 
     def read(self):
-        time.sleep(self.delay)
-        return [self.get_temp(i) for i in range(8)]
+        return self.read_channels()
 
     def filter(self, values):
-        return [0 < value < 1000 for value in values]
+        values = np.asarray(values, dtype=np.float64)
+        return (self.min_temp < values) & (values < self.max_temp)
+
+    def close(self):
+        """Shut down the channel thread pool and release the DAQ device if it was detected automatically."""
+        if hasattr(self, "executor"):
+            self.executor.shutdown(wait=False)
+        if self.use_device_detection:
+            ul.release_daq_device(self.board_num)
 
 
 class MOTBox(Arduino_Sensor):
@@ -286,20 +523,58 @@ class Logger(object):
 
     Args:
         name (str): A name to associate with the logger.
+        batch_size (int): Number of data points to collect before uploading. Defaults to 5000.
+        flush_interval (float): Maximum time in seconds between uploads. Defaults to 1 second.
+        protocol (str): Data format. Either "json" for data point dictionaries or "line" for InfluxDB line protocol
+            strings, one per sensor. Defaults to "json".
+        time_precision (str): Timestamp precision. One of "n", "u", "ms", "s", "m" or "h". Defaults to "n".
+        max_points (int): Maximum number of data points held in memory between uploads. Defaults to 100000.
+        background_upload (bool): Upload in a background thread so slow uploads do not delay the sensor readings.
+            Defaults to False.
 
     Attributes:
         name (str): A name to associate with the logger.
         sensors (list): List of sensor objects.
-        data (list): List of data point dictionaries.
+        data (collections.deque): Data point dictionaries or line protocol strings waiting to be uploaded. Holds at
+            most max_points points; the oldest points are dropped when it is full.
+        protocol (str): Data format. Either "json" or "line".
+        time_precision (str): Timestamp precision. One of "n", "u", "ms", "s", "m" or "h".
         client: Database client.
         backup_dir (str): Directory for saving backup files. Defaults to "./backups".
+        batch_size (int): Number of data points to collect before uploading.
+        flush_interval (float): Maximum time in seconds between uploads.
+        last_flush (float): Monotonic time of the last upload.
+        executor (concurrent.futures.ThreadPoolExecutor): Thread pool for reading the sensors concurrently.
+        packet_size (int): Number of data points per UDP datagram, or None when connected over HTTP.
+        upload_queue (queue.Queue): Batches waiting for the background upload thread, or None when uploading in the
+            calling thread.
+        upload_thread (threading.Thread): Background upload thread, or None when uploading in the calling thread.
+        backup_lock (threading.Lock): Lock for writing backup files from more than one thread.
     """
-    def __init__(self, name):
+    def __init__(self, name, batch_size=5000, flush_interval=1.0, protocol="json", time_precision="n", max_points=100000,
+                 background_upload=False):
+        if time_precision not in TIME_PRECISION_NS:
+            raise ValueError("Invalid time precision '%s'." % time_precision)
         self.name = name
         self.sensors = []
-        self.data = []
+        self.data = collections.deque(maxlen=max_points)
+        self.protocol = protocol
+        self.time_precision = time_precision
         self.client = None
         self.backup_dir = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.executor = None
+        self.packet_size = None
+        self.upload_queue = None
+        self.upload_thread = None
+        self.backup_lock = threading.Lock()
+        if background_upload:
+            self.upload_queue = queue.Queue(maxsize=100)
+            self.upload_thread = threading.Thread(target=self.upload_worker, daemon=True)
+            self.upload_thread.start()
+            atexit.register(self.flush)
 
     def add_sensors(self, *args):
         """
@@ -309,6 +584,9 @@ class Logger(object):
             *args: Sensor objects.
         """
         self.sensors.extend(*args)
+        for sensor in self.sensors:
+            sensor.cache_field_keys()
+        self.reset_executor()
 
     def remove_sensor(self, sensor_object):
         """
@@ -318,8 +596,15 @@ class Logger(object):
             sensor_object: Sensor object.
         """
         self.sensors = [sensor for sensor in self.sensors if sensor != sensor_object]
+        self.reset_executor()
 
-    def connect(self, url, port, username, pwd, db_name, backup_dir=os.path.join(os.getcwd(), "backups")):
+    def reset_executor(self):
+        """Shut down the sensor thread pool so that it is recreated with one thread per sensor on the next read."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def connect(self, url, port, username, pwd, db_name, backup_dir=os.path.join(os.getcwd(), "backups"), **kwargs):
         """
         Connect to the client.
         It is recommended that you use a config file for sensitive information.
@@ -330,75 +615,248 @@ class Logger(object):
             username (str): Database username.
             pwd (str): Database password.
             db_name (str): Database name.
-            backup_dir (str): Directory for saving backup files. Defaults to "./backups".
+            backup_dir (str): Directory for saving backup files. It is created if it does not exist. Defaults to
+                "./backups".
+            **kwargs: Keyword arguments for InfluxDBClient, e.g. timeout, retries, pool_size or gzip. The client keeps
+                its HTTP connections open between uploads.
         """
+        self.backup_dir = backup_dir
+        self.packet_size = None
+        try:
+            os.makedirs(self.backup_dir, exist_ok=True)
+        except OSError as err:
+            log.error("Failed to create backup directory '%s': %s", self.backup_dir, err)
         try:
-            self.client = InfluxDBClient(url, port, username, pwd, db_name)
-            self.backup_dir = backup_dir
+            from influxdb import InfluxDBClient
+            self.client = InfluxDBClient(url, port, username, pwd, db_name, **kwargs)
         except Exception as err:
-            print("Failed to connect to database.")
-            print(err)
+            log.error("Failed to connect to database: %s", err)
 
-    def upload_custom(self, data):
-        """Upload custom data to the client."""
+    def connect_udp(self, url, udp_port=4444, packet_size=100, backup_dir=os.path.join(os.getcwd(), "backups")):
+        """
+        Connect to the client over UDP. Uploads are sent without waiting for a response from the server, which is
+        faster but points can be lost without an error, so only use this for sensors where that is acceptable.
+        The database and timestamp precision are set by the UDP listener in the InfluxDB configuration.
+
+        Args:
+            url (str): Database url.
+            udp_port (int): Port of the InfluxDB UDP listener. Defaults to 4444.
+            packet_size (int): Number of data points per datagram. Datagrams are limited to 64 KB. Defaults to 100.
+            backup_dir (str): Directory for saving backup files. Defaults to "./backups".
+        """
+        self.connect(url, 8086, "root", "root", None, backup_dir=backup_dir, use_udp=True, udp_port=udp_port)
+        self.packet_size = packet_size
+
+    def upload_custom(self, data, protocol="json", time_precision="n"):
+        """
+        Upload custom data to the client.
+
+        Args:
+            data (list): List of data point dictionaries or line protocol strings.
+            protocol (str): Data format. Either "json" or "line". Defaults to "json".
+            time_precision (str): Precision of the timestamps in the data. Defaults to "n", which matches the
+                nanosecond timestamps of Picoscope data.
+        """
         try:
-            self.client.write_points(data)
+            self.client.write_points(data, time_precision=time_precision, protocol=protocol)
         except Exception as e:
-            print("Failed to upload data. Saving data to backup directory.")
-            print(e)
-            os.makedirs(self.backup_dir, exist_ok=True)
-            file_name = "{}-missed.json".format(time.time())
-            backup_path = os.path.join(self.backup_dir, file_name)
-            with open(backup_path, "w") as outfile:
-                json.dump(data, outfile)
+            log.error("Failed to upload data. Saving data to backup directory: %s", e)
+            self.backup(data, protocol, time_precision)
+
+    def backup(self, data, protocol="json", time_precision=None):
+        """
+        Append data to the backup file for the current day and timestamp precision.
+        Data point dictionaries are written as newline-delimited JSON to "<date>-missed-<precision>.ndjson" and line
+        protocol strings as plain lines to "<date>-missed-line-<precision>.txt".
+        If zstandard is installed, each backup is appended as a compressed zstd frame to a ".zst" file.
+        If the backup cannot be written, the error is logged and the data is lost.
 
-    def upload(self):
-        """Upload the data to the client. If the upload fails, write the data to a backup file."""
+        Args:
+            data (list): List of data point dictionaries or line protocol strings.
+            protocol (str): Data format. Either "json" or "line". Defaults to "json".
+            time_precision (str): Precision of the timestamps in the data. Defaults to Logger.time_precision.
+        """
+        date = time.strftime("%Y-%m-%d")
+        time_precision = time_precision or self.time_precision
+        if protocol == "line":
+            file_name = "{}-missed-line-{}.txt".format(date, time_precision)
+            payload = "".join(line + "\n" for line in data).encode()
+        else:
+            file_name = "{}-missed-{}.ndjson".format(date, time_precision)
+            payload = dump_ndjson(data)
+        if zstandard is not None:
+            file_name += ".zst"
+            payload = zstandard.ZstdCompressor(level=3).compress(payload)
+        with self.backup_lock:
+            try:
+                os.makedirs(self.backup_dir, exist_ok=True)
+                with open(os.path.join(self.backup_dir, file_name), "ab") as outfile:
+                    outfile.write(payload)
+            except OSError as err:
+                log.error("Could not write %d data points to backup file '%s': %s", len(data), file_name, err)
+
+    def upload(self, force=False):
+        """
+        Upload the data to the client once batch_size data points have been collected or flush_interval seconds
+        have passed since the last upload. If the upload fails, write the data to a backup file.
+        With background_upload, the data is handed to the upload thread instead. If the thread has fallen too far
+        behind, the data is written to a backup file straight away.
+
+        Args:
+            force (bool): Upload the data regardless of the batch size and flush interval.
+        """
+        if not force and len(self.data) < self.batch_size and time.monotonic() - self.last_flush < self.flush_interval:
+            return
+        self.last_flush = time.monotonic()
+        flush_log()
         if self.data:
+            data = list(self.data)
+            self.data.clear()
+            if self.upload_queue is None:
+                self.write_batch(data, self.protocol)
+            else:
+                try:
+                    self.upload_queue.put_nowait((data, self.protocol))
+                except queue.Full:
+                    log.warning("Upload queue is full. Saving data to backup directory.")
+                    self.backup(data, self.protocol)
+
+    def write_batch(self, data, protocol):
+        """
+        Write a batch of data points to the client. If the upload fails, write the data to a backup file.
+
+        Args:
+            data (list): List of data point dictionaries or line protocol strings.
+            protocol (str): Data format. Either "json" or "line".
+        """
+        try:
+            self.client.write_points(data, time_precision=self.time_precision, batch_size=self.packet_size or self.batch_size, protocol=protocol)
+        except Exception as e:
+            log.error("Failed to upload data. Saving data to backup directory: %s", e)
+            self.backup(data, protocol)
+
+    def upload_worker(self):
+        """Upload batches from the upload queue. Runs in the background upload thread."""
+        while True:
+            data, protocol = self.upload_queue.get()
             try:
-                self.client.write_points(self.data)
+                self.write_batch(data, protocol)
             except Exception as e:
-                print("Failed to upload data. Saving data to backup directory.")
-                print(e)
-                os.makedirs(self.backup_dir, exist_ok=True)
-                file_name = "{}-missed.json".format(time.time())
-                backup_path = os.path.join(self.backup_dir, file_name)
-                with open(backup_path, "w") as outfile:
-                    json.dump(self.data, outfile)
-            self.data = []
+                log.error("Upload thread lost a batch of %d data points: %s", len(data), e)
+            finally:
+                self.upload_queue.task_done()
+
+    def flush(self):
+        """Upload all collected data immediately and wait for the background upload thread, e.g. before shutting down."""
+        self.upload(force=True)
+        if self.upload_queue is not None:
+            self.upload_queue.join()
 
     def generate_body(self):
-        """Read data from the sensors and generate a data point dictionary."""
-        current_time = str(datetime.datetime.utcnow())
+        """
+        Read data from the sensors concurrently and add a data point dictionary with the fields of all sensors to
+        Logger.data. In line protocol mode, one line per sensor is added to Logger.data instead and the returned dictionary has no fields.
+        """
+        current_time = time.time_ns() // TIME_PRECISION_NS[self.time_precision]
         data_body = dict(measurement="{}".format(self.name), time=current_time, fields={})
-        for sensor in self.sensors:
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.sensors)))
+        futures = [self.executor.submit(sensor.read) for sensor in self.sensors]
+        for sensor, future in zip(self.sensors, futures):
             try:
-                sensor.read()
-                mask = sensor.filter(sensor.values) if sensor.filter else [True] * len(sensor.channels)
-                for filter_pass, channel, value in zip(mask, sensor.channels, sensor.values):
-                    if filter_pass:
-                        channel_name = "{} {}".format(sensor.name, channel)
-                        data_body["fields"][channel_name] = value
-                sensor.print_measurements()
-                self.data.append(data_body)
+                future.result()
+                self.add_fields(data_body, sensor)
             except Exception as e:
                 sensor.print_error(e)
+        if data_body["fields"]:
+            self.data.append(data_body)
         return data_body
 
-    def upload_backups(self):
-        """Upload data from backup files."""
+    async def generate_body_async(self):
+        """Read data from all sensors concurrently and generate a data point dictionary."""
+        current_time = time.time_ns() // TIME_PRECISION_NS[self.time_precision]
+        data_body = dict(measurement="{}".format(self.name), time=current_time, fields={})
+        results = await asyncio.gather(*[sensor.read_async() for sensor in self.sensors], return_exceptions=True)
+        for sensor, result in zip(self.sensors, results):
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                self.add_fields(data_body, sensor)
+            except Exception as e:
+                sensor.print_error(e)
+        if data_body["fields"]:
+            self.data.append(data_body)
+        return data_body
+
+    def add_fields(self, data_body, sensor):
+        """
+        Add the filtered measurements of a sensor to a data point dictionary.
+
+        Args:
+            data_body (dict): Data point dictionary.
+            sensor: Sensor object which has already been read.
+        """
+        values = sensor.values
+        mask = sensor.filter(values) if sensor.filter else None
+        if self.protocol == "line":
+            line = sensor.format_line(self.name, data_body["time"], mask)
+            if line:
+                self.data.append(line)
+            sensor.print_measurements()
+            return
+        fields = zip(sensor.field_keys, values)
+        data_body["fields"].update(fields if mask is None else itertools.compress(fields, mask))
+        sensor.print_measurements()
+
+    def upload_backups(self, chunk_size=5000):
+        """
+        Upload data from backup files. Each file is read line by line and uploaded in chunks of chunk_size data points,
+        so the backups never have to fit in memory. The timestamp precision is taken from the file name. Compressed
+        ".zst" backups require zstandard. Each file is renamed to "<name>.uploading" before it is read, so that data
+        appended to the daily backup file in the meantime goes to a new file. A file is removed once all of its data
+        has been uploaded; if an upload fails, it is kept and retried on the next call.
+        Backups can only be recovered over HTTP, since UDP uploads can be lost without an error. After connect_udp,
+        call connect before uploading them.
+
+        Args:
+            chunk_size (int): Number of data points per upload. Defaults to 5000.
+        """
+        if self.packet_size is not None:
+            log.error("Backups cannot be uploaded over UDP. Connect with Logger.connect to upload them.")
+            return
         try:
-            for file in os.listdir(self.backup_dir):
-                if file.endswith('-missed.json'):
-                    backup_path = os.path.join(self.backup_dir, file)
-                    with open(backup_path, 'r') as loadfile:
-                        backup_data = json.load(loadfile)
-                        self.data += backup_data
-                    os.remove(backup_path)
+            for file in sorted(os.listdir(self.backup_dir)):
+                backup_path = os.path.join(self.backup_dir, file)
+                match = BACKUP_FILE_RE.search(file)
+                if match:
+                    if not match.group(4):
+                        uploading_path = backup_path + ".uploading"
+                        if os.path.exists(uploading_path):
+                            continue  # Upload the file left over from a failed call first
+                        with self.backup_lock:
+                            os.replace(backup_path, uploading_path)
+                        backup_path = uploading_path
+                    protocol = "line" if match.group(1) else "json"
+                    time_precision = match.group(2) or self.time_precision
+                    if protocol == "line":
+                        parse = str.rstrip
+                    else:
+                        parse = orjson.loads if orjson is not None else json.loads
+                    with open_backup(backup_path, compressed=bool(match.group(3))) as loadfile:
+                        backup_data = (parse(line) for line in loadfile if line.strip())
+                        self.client.write_points(backup_data, time_precision=time_precision, batch_size=chunk_size, protocol=protocol)
+                elif file.endswith('-missed.json') or file.endswith('-missed-line.json'):
+                    with open(backup_path, 'rb') as loadfile:
+                        backup_data = orjson.loads(loadfile.read()) if orjson is not None else json.load(loadfile)
+                    protocol = "line" if file.endswith('-missed-line.json') else "json"
+                    self.client.write_points(backup_data, time_precision="n", batch_size=chunk_size, protocol=protocol)
+                else:
+                    continue
+                os.remove(backup_path)
         except Exception as err:
-            print(err)
+            log.error("Failed to upload backup data: %s", err)
         if self.data:
             try:
-                self.upload()
+                self.upload(force=True)
             except Exception as err:
-                print(err)
+                log.error(err)
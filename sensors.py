@@ -1,10 +1,24 @@
 from sensor_classes import *
 
 if __name__ == "__main__":
-    logger = Logger("example")
+    interval = 0.1  # Time between readings in seconds
+    logger = Logger("example", protocol="line")
     logger.connect(**parse_config("config.config"))
     sensors = [MOTBox("MOTBox", "/dev/cu.usbmodem69511901", print_m=True)]
     logger.add_sensors(sensors)
-    while True:
-        logger.generate_body()
-        logger.upload()
+    next_time = time.monotonic()
+    try:
+        while True:
+            logger.generate_body()
+            logger.upload()
+            # Schedule from the previous tick rather than the end of this one so that read and upload time does not add up
+            next_time += interval
+            sleep_time = next_time - time.monotonic()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            else:
+                log.warning("Reading took longer than the interval. Skipping to the next tick.")
+                next_time += (-sleep_time // interval + 1) * interval
+                time.sleep(max(0, next_time - time.monotonic()))
+    finally:
+        logger.flush()